@@ -1,22 +1,32 @@
 import asyncio
 import binascii
-import bisect
+import logging
 import sys
-import time
 from asyncio import sleep
+from bisect import bisect_left, bisect_right
+from time import time
 from typing import Any, Optional
 
-from app.expiry import (EXPIRY_TIMESTAMP_DEFAULT_VAL, check_key_expiration,
-                        get_expiry_timestamp)
-from app.resp import RESPReader, RESPWriter
-from app.util import generate_random_string
+from app import expiry
+from app.expiry import lazy_free, set_key_expiry
+from app.replication import REPLCONF_GETACK, flush_replicas
+from app.resp import NULL_BULK, OK, PONG, RESPReader, RESPWriter
 
-stream_entries = dict[str, str]
-stream = dict[str, stream_entries]
-streams: dict[str, stream] = {}  # stream_key -> stream
+logger = logging.getLogger(__name__)
+
+stream_id = int  # (timestamp << 64) | sequence, see _encode_stream_entry_id
+SEQUENCE_BITS = 64
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+stream_entries = dict[bytes, bytes]
+stream = dict[stream_id, stream_entries]
+streams: dict[bytes, stream] = {}  # stream_key -> stream
+# stream_key -> entry ids in ascending order. XADD only accepts ids greater
+# than the stream's top item, so appending keeps this list sorted.
+stream_ids: dict[bytes, list[stream_id]] = {}
 
 
 type_mapping = {
+    "bytes": "string",
     "str": "string",
     "int": "integer",
     "float": "float",
@@ -25,27 +35,38 @@ type_mapping = {
     "set": "set",
     "bool": "boolean",
     "NoneType": "none",
-    "stream_key_type": "stream",
 }
 
 
-class stream_key_type:
-    def __init__(self, val: str):
-        val = val
+# Empty RDB file sent to replicas after FULLRESYNC. It never changes, so the
+# RESP framed payload ("$<length>\r\n<contents>", no trailing CRLF) is built
+# once at import.
+EMPTY_RDB_HEX = (
+    "524544495330303131fa0972656469732d76657205372e322e30"
+    "fa0a72656469732d62697473c040fa056374696d65c26d08bc65"
+    "fa08757365642d6d656dc2b0c41000fa08616f662d62617365c0"
+    "00fff06e3bfec0ff5aa2"
+)
+_empty_rdb = binascii.unhexlify(EMPTY_RDB_HEX)
+EMPTY_RDB_PAYLOAD = b"$%d\r\n%b" % (len(_empty_rdb), _empty_rdb)
+
 
+# Placeholder value stored in the datastore under each stream key, so TYPE
+# can tell streams apart. The entries themselves live in `streams`.
+STREAM_TYPE = object()
 
-async def handle_ping(writer: RESPWriter):
+
+async def handle_ping(writer: RESPWriter, msg: list[bytes]):
     """
     Handles the PING command from the Redis client.
 
-    This function simply writes the "PONG" response to the `writer` using the
-    `write_simple_string` method.
+    This function simply writes the pre-serialized "PONG" response to the
+    `writer` using the `write_raw` method.
     """
-    response = "PONG"
-    await writer.write_simple_string(response)
+    writer.write_raw(PONG)
 
 
-async def handle_echo(writer: RESPWriter, msg: list[str]):
+async def handle_echo(writer: RESPWriter, msg: list[bytes]):
     """
     Handles the ECHO command from the Redis client.
 
@@ -54,30 +75,36 @@ async def handle_echo(writer: RESPWriter, msg: list[str]):
     method.
     """
     response = msg[1]
-    await writer.write_bulk_string(response)
+    writer.write_bulk_string(response)
 
 
 async def handle_type(
-    writer: RESPWriter, msg: list[str], datastore: dict[str, tuple[Any, int]]
+    writer: RESPWriter, msg: list[bytes], datastore: dict[bytes, Any]
 ):
     """
     Handles the TYPE command from the Redis client.
-    This function extracts the message to echo from the second element of the
-    `msg` list and writes it back to the client using the `write_bulk_string`
-    method.
+    This function looks up the key from the second element of the `msg` list
+    and writes the name of its value's type back to the client using the
+    `write_simple_string` method. Stream keys are recognised by the
+    `STREAM_TYPE` placeholder, other values by their Python type.
     """
     key = msg[1]
-    value, _ = datastore.get(key, (None, None))
+    value = datastore.get(key)
     if value is None:
-        type_name = "none"
+        response = "none"
+    elif value is STREAM_TYPE:
+        response = "stream"
     else:
         type_name = (type(value)).__name__
-    response = type_mapping.get(type_name, "none")
-    await writer.write_simple_string(response)
+        response = type_mapping.get(type_name, "none")
+    writer.write_simple_string(response)
 
 
 async def handle_set(
-    writer: RESPWriter, msg: list[str], DATASTORE: dict[str, tuple[str, int]]
+    writer: RESPWriter,
+    msg: list[bytes],
+    DATASTORE: dict[bytes, Any],
+    EXPIRIES: dict[bytes, int],
 ):
     """
     Handles the SET command from the Redis client.
@@ -86,45 +113,70 @@ async def handle_set(
     * Extracts the key and value from the `msg` list.
     * Checks if an optional TTL (time-to-live) is provided, else sets a default
       placeholder.
-    * Updates the `DATASTORE` dictionary with the new key-value pair and expiry
-      timestamp.
-    * Writes the "OK" response to the client using the `write_simple_string`
-      method.
+    * Updates the `DATASTORE` dictionary with the new key-value pair.
+    * Records the expiry timestamp in `EXPIRIES` and registers the key for
+      active expiry, if a TTL was provided, else clears any previous one.
+    * Writes the pre-serialized "OK" response to the client using the
+      `write_raw` method.
     """
     key, value = msg[1], msg[2]
-    DATASTORE[key] = (value, get_expiry_timestamp(msg))
-    await writer.write_simple_string("OK")
+    DATASTORE[key] = value
+    # `get_expiry_timestamp` and the no TTL case of `set_key_expiry`, inlined
+    # as SET is on the hot path, keep both in sync.
+    if len(msg) > 3:
+        ttl = int(msg[4])
+        if msg[3] == b"ex":  # seconds
+            ttl = ttl * 1000
+        set_key_expiry(EXPIRIES, key, expiry.cached_timestamp + ttl)
+    else:
+        EXPIRIES.pop(key, None)
+    writer.write_raw(OK)
 
 
 async def handle_get(
-    writer: RESPWriter, msg: list[str], DATASTORE: dict[str, tuple[str, int]]
+    writer: RESPWriter,
+    msg: list[bytes],
+    DATASTORE: dict[bytes, Any],
+    EXPIRIES: dict[bytes, int],
 ):
     """
     Handles the GET command from the Redis client.
 
     This function performs the following actions:
-    * Retrieves the key from the `msg` list.
-    * Checks if the key exists in the `DATASTORE` dictionary.
+    * Retrieves the key from the `msg` list, and looks it up once in the
+      `DATASTORE` dictionary, by subscript rather than `.get()` as most GETs
+      are hits.
     * If the key exists:
-        * Checks if the key has expired using the `check_key_expiration`
-          function.
+        * Checks if the key has expired, by comparing its expiry timestamp
+          with the current timestamp. `EXPIRIES` is only consulted here, and
+          only holds keys with a TTL.
         * If not expired, returns the value to the client using the
           `write_bulk_string` method.
         * If expired, passively removes the key from the `DATASTORE` and
-          returns a null bulk string to the client.
+          `EXPIRIES`, handing its value to `lazy_free`, and returns a null
+          bulk string to the client.
     * If the key doesn't exist, returns a null bulk string to the client.
+
+    The expiry is checked inline, rather than by a helper, as GET is on the
+    hot path.
     """
     key = msg[1]
-    default_value = (None, EXPIRY_TIMESTAMP_DEFAULT_VAL)
-    value, expiry_timestamp = DATASTORE.get(key, default_value)
-    expired = check_key_expiration(DATASTORE, key, expiry_timestamp)
-    if expired:
+    try:
+        value = DATASTORE[key]
+    except KeyError:
         value = None
-    await writer.write_bulk_string(value)
+    else:
+        expiry_timestamp = EXPIRIES.get(key)
+        if expiry_timestamp is not None:
+            if expiry.cached_timestamp > expiry_timestamp:
+                lazy_free(DATASTORE.pop(key))
+                del EXPIRIES[key]
+                value = None
+    writer.write_bulk_string(value)
 
 
 async def handle_config_get(
-    writer: RESPWriter, msg: list[str], CONFIG: dict[str, str]
+    writer: RESPWriter, msg: list[bytes], CONFIG: dict[str, str]
 ):
     """
     Handles the CONFIG GET command from the Redis client.
@@ -132,128 +184,129 @@ async def handle_config_get(
     This function retrieves the requested configuration value from the `CONFIG`
     dictionary and sends it back to the client as an RESP array.
     """
-    key = msg[2]
+    key = msg[2].decode()
     value = CONFIG.get(key, None)
-    await writer.write_array([key, value])
+    writer.write_array([key, value])
 
 
 async def handle_list_keys(
-    writer: RESPWriter, msg: list[str], DATASTORE: dict[str, tuple[str, int]]
+    writer: RESPWriter, msg: list[bytes], DATASTORE: dict[bytes, Any]
 ):
     """
     Handles the KEYS * command from the Redis client.
 
-    This function retrieves the list of all keys from the DATASTORE and sends
-    it back to the client as an RESP array.
+    This function sends all keys of the DATASTORE back to the client as an
+    RESP array, serializing straight from the dict's key view.
     """
     key = msg[1]
-    assert key == "*"
-    key_list = list(DATASTORE.keys())
-    await writer.write_array(key_list)
+    assert key == b"*"
+    writer.write_array(DATASTORE.keys())
 
 
-async def handle_info(writer: RESPWriter, msg: list[str], role: str):
+async def handle_info(
+    writer: RESPWriter, msg: list[bytes], role: str, master_replid: str
+):
     """
     Handles the INFO command from the Redis client.
     """
-    header = f"# {msg[1]}.capitalize()"
+    header = f"# {msg[1].decode()}.capitalize()"
     response = f"{header}\r\nrole:{role}"
     if role == "master":
-        response += f"\r\nmaster_replid:{generate_random_string(40)}"
+        response += f"\r\nmaster_replid:{master_replid}"
         response += "\r\nmaster_repl_offset:0"
 
-    await writer.write_bulk_string(response)
+    writer.write_bulk_string(response)
 
 
-async def handle_replconf(writer: RESPWriter, msg: list[str]):
+async def handle_replconf(writer: RESPWriter, msg: list[bytes]):
     """
     Handles the REPLCONF command from the Redis client.
     """
-    response = "OK"
-    await writer.write_simple_string(response)
+    writer.write_raw(OK)
 
 
-async def handle_psync(writer: RESPWriter, msg: list[str]):
+async def handle_psync(
+    writer: RESPWriter, msg: list[bytes], master_replid: str
+):
     """
-    Handles the REPLCONF command from the Redis client.
+    Handles the PSYNC command from the Redis client.
     """
-    response = f"FULLRESYNC {generate_random_string(40)} 0"
-    await writer.write_simple_string(response)
+    response = f"FULLRESYNC {master_replid} 0"
+    writer.write_simple_string(response)
 
 
-async def handle_rdb_transfer(writer: RESPWriter, msg: list[str]):
+async def handle_rdb_transfer(writer: RESPWriter, msg: list[bytes]):
     """
-    Handles the REPLCONF command from the Redis client.
+    Handles the RDB file transfer that follows a FULLRESYNC, by sending the
+    precomputed empty RDB payload to the replica.
     """
-    hex_str = (
-        "524544495330303131fa0972656469732d76657205372e322e30"
-        "fa0a72656469732d62697473c040fa056374696d65c26d08bc65"
-        "fa08757365642d6d656dc2b0c41000fa08616f662d62617365c0"
-        "00fff06e3bfec0ff5aa2"
-    )
-
-    try:
-        # Decode the hex string to bytes
-        bytes_data = binascii.unhexlify(hex_str)
-    except binascii.Error as e:
-        print(f"Encountered {e} while decoding hex string")
-        return None  # Adjust based on how you want to handle errors
-
-    resp = b"$" + str(len(bytes_data)).encode() + b"\r\n"
-    message = resp + bytes_data
-
-    await writer.write_raw(message)
+    writer.write_raw(EMPTY_RDB_PAYLOAD)
 
 
 async def handle_wait(
     writer: RESPWriter,
     replicas: list[tuple[RESPReader, RESPWriter]],
     master_offset: int,
-    msg: list[str],
+    msg: list[bytes],
 ):
     """
     Handles the WAIT command from the Redis client.
     """
+    # WAIT can block up to its timeout, replies to the commands pipelined
+    # before it are sent first.
+    await writer.flush()
     updated_replicas = 0
-    start_time = time.time()
+    start_time = time()
 
-    await asyncio.sleep(0.125)
+    await sleep(0.125)
     num_replicas, timeout = int(msg[1]), int(msg[2])
 
     if master_offset == 0:
         response = len(replicas)
     else:
+        # Ask every replica for its offset at once, then wait for all the
+        # ACKs concurrently, so WAIT costs one round trip, not one per replica.
         for repl_reader, repl_writer in replicas:
-            await repl_writer.write_array(["REPLCONF", "GETACK", "*"])
+            repl_writer.write_raw(REPLCONF_GETACK)
+        await flush_replicas(replicas)
 
-        for repl_reader, repl_writer in replicas:
-            try:
-                response = await asyncio.wait_for(
-                    repl_reader.read_array(skip_first_byte=True), timeout=0.125
+        acks = await asyncio.gather(
+            *(
+                asyncio.wait_for(
+                    r.read_array(skip_first_byte=True), timeout=0.125
                 )
-                print("response", response)
-                if response[0] == "REPLCONF" and response[1] == "ACK":
-                    repl_offset = int(response[2])
-                    if repl_offset >= master_offset:
-                        updated_replicas += 1
-            except asyncio.TimeoutError:
-                print("Timeout expired. No data received.")
+                for r, _ in replicas
+            ),
+            return_exceptions=True,
+        )
+        for ack in acks:
+            if isinstance(ack, asyncio.TimeoutError):
+                logger.debug("Timed out waiting for a replica ACK")
+                continue
+            if isinstance(ack, BaseException):
+                logger.debug("Encountered %r while reading ACK", ack)
+                continue
+            logger.debug("Received ACK %r", ack)
+            if ack and ack[0] == b"REPLCONF" and ack[1] == b"ACK":
+                repl_offset = int(ack[2])
+                if repl_offset >= master_offset:
+                    updated_replicas += 1
 
         response = updated_replicas
 
-    end_time = time.time()
+    end_time = time()
     elapsed_time = (end_time - start_time) * 1000
 
     if response < num_replicas and master_offset != 0:
         t = max(0, timeout - elapsed_time)
-        print(f"Waiting for {t} ms.")
-        await asyncio.sleep(t / 1000)
-    await writer.write_integer(response)
+        logger.debug("Waiting for %s ms", t)
+        await sleep(t / 1000)
+    writer.write_integer(response)
     return
 
 
 async def handle_xadd(
-    writer: RESPWriter, msg: list[str], datastore: dict[str, tuple[Any, int]]
+    writer: RESPWriter, msg: list[bytes], datastore: dict[bytes, Any]
 ):
     stream_key = msg[1]
     stream_entry_id = msg[2]
@@ -263,126 +316,115 @@ async def handle_xadd(
     for i in range(0, len(stream_entry_list), 2):
         stream_entry[stream_entry_list[i]] = stream_entry_list[i + 1]
     stream = streams.get(stream_key, {})
+    ids = stream_ids.get(stream_key, [])
 
-    if stream_entry_id == "*":
-        current_timestamp = int(time.time() * 1000)
-        current_sequence = 0
+    if stream_entry_id == b"*":
+        # Fully auto-generated: the sequence is picked below, like "<ts>-*".
+        timestamp = expiry.cached_timestamp
+        sequence_part = b"*"
     else:
-        current_timestamp, current_sequence = stream_entry_id.split("-")
-        current_timestamp = int(current_timestamp)
+        timestamp_part, sequence_part = stream_entry_id.split(b"-")
+        timestamp = int(timestamp_part)
 
-    if len(stream) > 0:
-        stream_last_entry_id = sorted(list(stream.keys()))[-1]
-        stream_last_entry = stream[stream_last_entry_id]
-    else:
-        stream_last_entry = None
-
-    if current_sequence == "*":
-        if stream_last_entry is None:
-            if current_timestamp != 0:
-                current_sequence = 0
-            else:
-                current_sequence = 1
+    # Entry ids only ever grow, so the top item is the last one in `ids`.
+    stream_last_entry_id = ids[-1] if ids else None
+
+    if sequence_part == b"*":
+        if (
+            stream_last_entry_id is not None
+            and timestamp == stream_last_entry_id >> SEQUENCE_BITS
+        ):
+            sequence = (stream_last_entry_id & SEQUENCE_MASK) + 1
+        elif timestamp != 0:
+            sequence = 0
         else:
-            stream_last_entry_id = sorted(list(stream.keys()))[-1]
-            stream_last_entry_timestamp, stream_last_entry_sequence = (
-                stream_last_entry_id.split("-")
-            )
-            stream_last_entry_timestamp = int(stream_last_entry_timestamp)
-            stream_last_entry_sequence = int(stream_last_entry_sequence)
-            if current_timestamp == stream_last_entry_timestamp:
-                current_sequence = stream_last_entry_sequence + 1
-            else:
-                if current_timestamp != 0:
-                    current_sequence = 0
-                else:
-                    current_sequence = 1
+            sequence = 1
     else:
-        current_sequence = int(current_sequence)
+        sequence = int(sequence_part)
 
-    stream_entry_id = f"{current_timestamp}-{current_sequence}"
+    try:
+        new_entry_id = _encode_stream_entry_id(timestamp, sequence)
+    except ValueError:
+        writer.write_simple_error(
+            "ERR Invalid stream ID specified as stream command argument"
+        )
+        return
 
-    if current_timestamp == 0 and current_sequence == 0:
-        await writer.write_simple_error(
+    if new_entry_id == 0:
+        writer.write_simple_error(
             "ERR The ID specified in XADD must be greater than 0-0"
         )
         return
-    if stream_last_entry is not None:
-        stream_last_entry_timestamp, stream_last_entry_sequence = (
-            stream_last_entry_id.split("-")
+    if stream_last_entry_id is not None and (
+        new_entry_id <= stream_last_entry_id
+    ):
+        writer.write_simple_error(
+            "ERR The ID specified in XADD is equal or smaller than the"
+            " target stream top item"
         )
-        stream_last_entry_timestamp = int(stream_last_entry_timestamp)
-        stream_last_entry_sequence = int(stream_last_entry_sequence)
-
-        if current_timestamp < stream_last_entry_timestamp or (
-            current_timestamp <= stream_last_entry_timestamp
-            and current_sequence <= stream_last_entry_sequence
-        ):
-            await writer.write_simple_error(
-                "ERR The ID specified in XADD is equal or smaller than the"
-                " target stream top item"
-            )
-            return
+        return
 
     # Add stream_key to Datastore as a new object stream()
-    stream[stream_entry_id] = stream_entry
+    stream[new_entry_id] = stream_entry
+    ids.append(new_entry_id)
     streams[stream_key] = stream
+    stream_ids[stream_key] = ids
 
-    datastore[stream_key] = (
-        stream_key_type(stream_key),
-        get_expiry_timestamp([]),
-    )  # No expiry
+    datastore[stream_key] = STREAM_TYPE  # No expiry
     # Add stream_key to datastore, to handle TYPE on it.
 
-    response = stream_entry_id
-    await writer.write_bulk_string(response)
+    response = _format_stream_entry_id(new_entry_id)
+    writer.write_bulk_string(response)
 
 
-async def handle_xrange(writer: RESPWriter, msg: list[str]):
+async def handle_xrange(writer: RESPWriter, msg: list[bytes]):
     stream_key = msg[1]
     stream_entry_id_start = msg[2]
     stream_entry_id_end = msg[3]
 
-    stream = streams.get(stream_key, [])  # Handle case where it is empty
-    stream_keys = sorted(list(stream.keys()))
+    stream = streams.get(stream_key, {})  # Handle case where it is empty
+    ids = stream_ids.get(stream_key, [])
 
-    if stream_entry_id_start == "-":
+    if stream_entry_id_start == b"-":
         start_idx = 0
     else:
-        start_idx = bisect.bisect_left(stream_keys, stream_entry_id_start)
+        start_idx = bisect_left(
+            ids, _parse_stream_entry_id(stream_entry_id_start, 0)
+        )
 
-    if stream_entry_id_end == "+":
-        end_idx = len(stream_keys) - 1
+    if stream_entry_id_end == b"+":
+        end_idx = len(ids)
     else:
-        end_idx = bisect.bisect_left(stream_keys, stream_entry_id_end)
+        end_idx = bisect_right(
+            ids, _parse_stream_entry_id(stream_entry_id_end, SEQUENCE_MASK)
+        )
 
-    output = _format_fetched_stream_entries_for_xrange(
-        _fetch_stream_entries(stream, stream_keys, start_idx, end_idx)
-    )
-    await writer.write_array(output)
+    output = _serialize_stream_entries(stream, ids[start_idx:end_idx])
+    writer.write_raw(output)
 
 
-async def handle_xread(writer: RESPWriter, msg: list[str]):
-    response = []
+async def handle_xread(writer: RESPWriter, msg: list[bytes]):
+    response: list[bytes] = []
 
-    if msg[1] == "block":
+    if msg[1] == b"block":
+        # Replies to the commands pipelined before this one are sent now,
+        # rather than held back for as long as XREAD blocks.
+        await writer.flush()
         blocking_time = int(msg[2])
         if blocking_time == 0:
             blocking_time = sys.maxsize
         stream_key = msg[4]
-        stream_entry_id = msg[5]
-        if stream_entry_id == "$":
-            stream = streams[stream_key]
-            if len(stream) == 0:
-                stream_entry_id = "0-0"
-            else:
-                stream_entry_id = sorted(list(stream.keys()))[-1]
+        if msg[5] == b"$":
+            ids = stream_ids.get(stream_key, [])
+            stream_entry_id = ids[-1] if ids else 0
+        else:
+            stream_entry_id = _parse_stream_entry_id(msg[5], 0)
 
         stream_entry_id_start = await _new_entry_added_to_stream(
             stream_key, stream_entry_id, blocking_time / 1000
         )
         if stream_entry_id_start is None:
-            await writer.write_raw(b"$-1\r\n")
+            writer.write_raw(NULL_BULK)
             return
         output = _xread_on_single_stream(stream_key, stream_entry_id_start)
         response.append(output)
@@ -391,93 +433,104 @@ async def handle_xread(writer: RESPWriter, msg: list[str]):
 
         for op in range(stream_count):
             stream_key = msg[2 + op]
-            stream_entry_id_start = msg[2 + stream_count + op]
-            print(op, stream_key, stream_entry_id_start)
-
+            stream_entry_id_start = _parse_stream_entry_id(
+                msg[2 + stream_count + op], 0
+            )
             output = _xread_on_single_stream(stream_key, stream_entry_id_start)
             response.append(output)
 
-    await writer.write_array(response)
-
-
-def _fetch_stream_entries(
-    stream: dict[str, stream_entries],
-    stream_keys: list[str],
-    start_idx: int,
-    end_idx: int,
-) -> list[tuple[str, stream_entries]]:
-    entries: list[tuple[str, stream_entries]] = []
-    for key in stream_keys[start_idx : end_idx + 1]:
-        entries.append((key, stream[key]))
-    return entries
-
-
-def _format_fetched_stream_entries_for_xrange(
-    entries: list[tuple[str, stream_entries]],
-) -> list[str]:
-    inner_list_type = list[tuple[str, list[str]]]
-    output: list[inner_list_type] = []
-    for entry in entries:
-        inner: inner_list_type = []
-        key = entry[0]
-        inner.append(key)
-        d = entry[1]
-        d_as_list: list[str] = []
-        for k, v in d.items():
-            d_as_list.append(k)
-            d_as_list.append(v)
-        inner.append(d_as_list)
-        output.append(inner)
-    return output
-
-
-def _format_fetched_stream_entries_for_xread(
-    entries: list[tuple[str, stream_entries]], stream_key: str
-) -> list[str]:
-    inner_list_type = list[tuple[str, list[str]]]
-    output: list[inner_list_type] = []
-    for entry in entries:
-        inner: inner_list_type = []
-        key = entry[0]
-        inner.append(key)
-        d = entry[1]
-        d_as_list: list[str] = []
-        for k, v in d.items():
-            d_as_list.append(k)
-            d_as_list.append(v)
-        inner.append(d_as_list)
-        output.append(inner)
-
-    return [stream_key, output]
-
-
-def _xread_on_single_stream(stream_key: str, stream_entry_id_start: str):
-    stream = streams.get(stream_key, [])  # Handle case where it is empty
-    stream_keys = sorted(list(stream.keys()))
-
-    start_idx = bisect.bisect_left(stream_keys, stream_entry_id_start)
-    end_idx = len(stream_keys) - 1
-
-    entries = _fetch_stream_entries(stream, stream_keys, start_idx, end_idx)
-    output = _format_fetched_stream_entries_for_xread(entries, stream_key)
-    return output
+    writer.write_raw(b"*%d\r\n%b" % (len(response), b"".join(response)))
+
+
+def _encode_stream_entry_id(timestamp: int, sequence: int) -> stream_id:
+    """
+    Packs a stream entry id into a single int, with the timestamp in the high
+    bits and the sequence in the low `SEQUENCE_BITS` bits. Packed ids compare
+    in the same order as the (timestamp, sequence) pairs they encode. Raises
+    `ValueError` if the sequence doesn't fit in `SEQUENCE_BITS` bits, as it
+    would then overlap with the timestamp.
+    """
+    if not 0 <= sequence <= SEQUENCE_MASK:
+        raise ValueError(f"Stream entry id sequence out of range: {sequence}")
+    return (timestamp << SEQUENCE_BITS) | sequence
+
+
+def _parse_stream_entry_id(
+    entry_id: bytes, default_sequence: int
+) -> stream_id:
+    """
+    Parses a "<timestamp>-<sequence>" stream entry id into its packed int
+    form, so ids compare numerically rather than lexicographically. The
+    sequence part is optional in range queries, and `default_sequence` is used
+    when it is missing.
+    """
+    timestamp, _, sequence = entry_id.partition(b"-")
+    if not sequence:
+        return _encode_stream_entry_id(int(timestamp), default_sequence)
+    return _encode_stream_entry_id(int(timestamp), int(sequence))
+
+
+def _format_stream_entry_id(entry_id: stream_id) -> bytes:
+    return b"%d-%d" % (entry_id >> SEQUENCE_BITS, entry_id & SEQUENCE_MASK)
+
+
+def _serialize_stream_entries(stream: stream, ids: list[stream_id]) -> bytes:
+    """
+    Serializes the entries of `stream` with the given `ids` into the RESP
+    array returned by XRANGE and XREAD, [[entry_id, [field, value, ...]], ...].
+
+    The RESP bytes are written straight into a single buffer, without first
+    building the nested lists for `RESPWriter.write_array` to walk.
+    """
+    buf = bytearray(b"*%d\r\n" % len(ids))
+    for entry_id in ids:
+        entry = stream[entry_id]
+        encoded_id = _format_stream_entry_id(entry_id)
+        buf += b"*2\r\n$%d\r\n%b\r\n*%d\r\n" % (
+            len(encoded_id),
+            encoded_id,
+            2 * len(entry),
+        )
+        for field, value in entry.items():
+            buf += b"$%d\r\n%b\r\n$%d\r\n%b\r\n" % (
+                len(field),
+                field,
+                len(value),
+                value,
+            )
+    return bytes(buf)
+
+
+def _xread_on_single_stream(
+    stream_key: bytes, stream_entry_id_start: stream_id
+) -> bytes:
+    """
+    Serializes the entries of a single stream, starting at
+    `stream_entry_id_start`, as the [stream_key, entries] RESP array XREAD
+    returns for each stream.
+    """
+    stream = streams.get(stream_key, {})  # Handle case where it is empty
+    ids = stream_ids.get(stream_key, [])
+
+    start_idx = bisect_left(ids, stream_entry_id_start)
+    return b"*2\r\n$%d\r\n%b\r\n%b" % (
+        len(stream_key),
+        stream_key,
+        _serialize_stream_entries(stream, ids[start_idx:]),
+    )
 
 
 async def _new_entry_added_to_stream(
-    stream_key: str, stream_entry_id: str, total_time: float
-) -> Optional[str]:
+    stream_key: bytes, stream_entry_id: stream_id, total_time: float
+) -> Optional[stream_id]:
     WAIT_TIME = 0.125  # seconds
     slept = 0
     while True:
-        stream = streams[stream_key]
-        stream_keys = sorted(list(stream.keys()))
-        if len(stream_keys) == 0:
-            continue
-        latest_key = stream_keys[-1]
-        if latest_key > stream_entry_id:
+        ids = stream_ids.get(stream_key, [])
+        if ids and ids[-1] > stream_entry_id:
             break
         slept += WAIT_TIME
         if slept >= total_time:
             return None
         await sleep(WAIT_TIME)
-    return latest_key
+    return ids[-1]
@@ -1,68 +1,175 @@
 import asyncio
-import time
+from collections import deque
+from heapq import heappop, heappush
+from time import monotonic, time
+from typing import Any
 
 EXPIRY_TIMESTAMP_DEFAULT_VAL = 0
+# Wall clock in ms, refreshed every `CLOCK_TICK` by `clock_ticker`, so hot
+# paths read an int instead of calling time(). It is epoch based rather than
+# monotonic, as expiry timestamps (including those from the RDB) are absolute.
+# The tick matches `MIN_ACTIVE_KEY_EXPIRY_SLEEP`, the expiry granularity that
+# is already tolerated, and keeps an idle server at 100 wakeups a second.
+cached_timestamp = int(time() * 1000)  # ms
+CLOCK_TICK = 0.01  # seconds
+# Shortest sleep between two active expiry passes, so keys expiring a few ms
+# apart are removed in one pass rather than one wakeup each.
+MIN_ACTIVE_KEY_EXPIRY_SLEEP = 0.01  # seconds
+# Longest a single active expiry pass may run before yielding to the event
+# loop, checked every 16 keys like Redis' activeExpireCycle.
+ACTIVE_KEY_EXPIRY_TIME_LIMIT = 0.025  # seconds
+# Number of passes that stopped early because they hit the time limit.
+stat_expired_time_cap_reached_count = 0
+# Min-heap of (expiry_timestamp, key) for every key set with a TTL. Entries
+# are never removed on overwrite, stale ones are skipped when popped.
+expiry_heap: list[tuple[int, bytes]] = []
+# Set whenever a key gets an expiry earlier than the head of `expiry_heap`, so
+# `actively_expire_keys` can recompute how long to sleep.
+expiry_wakeup = asyncio.Event()
+# Values of deleted keys, dropped later by `lazy_free_worker` so freeing a big
+# value does not hold up the command that deleted the key.
+lazy_free_queue: deque[Any] = deque()
+lazy_free_wakeup = asyncio.Event()
+LAZY_FREE_BATCH_SIZE = 64  # values freed between two yields
+
+
+async def clock_ticker():
+    """
+    Refreshes `cached_timestamp` every `CLOCK_TICK`, for as long as the event
+    loop runs. Readers see a timestamp at most one tick (plus any time the
+    loop spends on a busy task) behind the wall clock.
+    """
+    global cached_timestamp
+    while True:
+        cached_timestamp = int(time() * 1000)  # ms
+        await asyncio.sleep(CLOCK_TICK)
 
 
 async def actively_expire_keys(
-    DATASTORE: dict[str, tuple[str, int]], ACTIVE_KEY_EXPIRY_TIME_WINDOW: int
+    DATASTORE: dict[bytes, Any],
+    EXPIRIES: dict[bytes, int],
+    ACTIVE_KEY_EXPIRY_TIME_WINDOW: float,
 ):
     """
-    Periodically scans the provided data store (dictionary) for expired keys
-    and removes them.
+    Periodically removes expired keys from the provided data store
+    (dictionary), using the `expiry_heap` to visit only the keys whose expiry
+    timestamp has already passed.
 
     This asynchronous function runs in an infinite loop, performing the
     following actions at each iteration:
     * Gets the current timestamp.
-    * Iterates through all keys in the data store.
-    * For each key, checks if its expiry timestamp is older than the current
-      timestamp (meaning it has expired).
-    * If a key is expired, it's removed from the data store.
-    * Waits for the specified `ACTIVE_KEY_EXPIRY_TIME_WINDOW` before repeating
-      the process.
-
-    This function ensures that keys with invalid expiry times are automatically
-    removed when they become stale, maintaining efficient memory usage in the
-    data store.
+    * Pops entries off the `expiry_heap` while the earliest expiry timestamp
+      is older than the current timestamp (meaning it has expired).
+    * For each popped entry, pops the key from `EXPIRIES`, and if it still
+      held that same expiry timestamp removes it from the data store too.
+      Entries left behind by keys that were overwritten or already passively
+      expired are simply discarded. Values are handed to `lazy_free`.
+    * Sleeps until the next expiry timestamp on the heap, or for the specified
+      `ACTIVE_KEY_EXPIRY_TIME_WINDOW` if there is none, before repeating the
+      process. The sleep is kept between `MIN_ACTIVE_KEY_EXPIRY_SLEEP` and
+      `ACTIVE_KEY_EXPIRY_TIME_WINDOW`, and is cut short by `expiry_wakeup`
+      when a key with an earlier expiry is set.
+    * A pass that runs longer than `ACTIVE_KEY_EXPIRY_TIME_LIMIT` stops
+      early, yields to the event loop so client commands get served, and
+      resumes right away instead of sleeping.
+
+    Each iteration costs O(k log N) for k expired keys, instead of a full scan
+    over the data store, and keys are removed as soon as they expire.
     """
+    global stat_expired_time_cap_reached_count
+    pop = heappop  # Local lookup in the loop below
     while True:
-        current_time = time.time()
-        expired_keys: list[str] = []
-        for key, (_, expiry_timestamp) in DATASTORE.items():
-            if current_time > expiry_timestamp:
-                expired_keys.append(key)
+        current_timestamp = cached_timestamp
+        start = monotonic()
+        expired = 0
+        timelimit_exit = False
+        while expiry_heap and expiry_heap[0][0] < current_timestamp:
+            expired += 1
+            if (expired & 0xF) == 0 and (
+                monotonic() - start > ACTIVE_KEY_EXPIRY_TIME_LIMIT
+            ):
+                timelimit_exit = True
+                break
+            expiry_timestamp, key = pop(expiry_heap)
+            # One probe for the common case, where the key still holds this
+            # expiry; a key that got a new expiry since is put back.
+            current_expiry = EXPIRIES.pop(key, None)
+            if current_expiry == expiry_timestamp:
+                lazy_free(DATASTORE.pop(key))
+            elif current_expiry is not None:
+                EXPIRIES[key] = current_expiry
 
-        for key in expired_keys:
-            del DATASTORE[key]
+        if timelimit_exit:
+            # More keys are already due, let other tasks run and carry on.
+            stat_expired_time_cap_reached_count += 1
+            await asyncio.sleep(0)
+            continue
 
-        await asyncio.sleep(ACTIVE_KEY_EXPIRY_TIME_WINDOW)
+        if expiry_heap:
+            # Wake up just after the earliest key expires (1 ms past it, as
+            # keys count as expired once the current timestamp exceeds it).
+            # Never sleep longer than the window, in case the clock jumps.
+            delay = (expiry_heap[0][0] - current_timestamp + 1) / 1000
+            delay = min(ACTIVE_KEY_EXPIRY_TIME_WINDOW, delay)
+            delay = max(MIN_ACTIVE_KEY_EXPIRY_SLEEP, delay)
+        else:
+            delay = ACTIVE_KEY_EXPIRY_TIME_WINDOW
+        expiry_wakeup.clear()
+        try:
+            await asyncio.wait_for(expiry_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
 
 
-def check_key_expiration(
-    DATASTORE: dict[str, tuple[str, int]], key: str, expiry_timestamp: int
-) -> bool:
+def set_key_expiry(
+    EXPIRIES: dict[bytes, int], key: bytes, expiry_timestamp: int
+):
     """
-    Checks if a specific key in the datastore has expired based on its expiry
-    timestamp. This function compares the current timestamp with the provided
-    `expiry_timestamp` stored for the key:
-
-    * If the `expiry_timestamp` is the default value (0), it signifies the key
-      never expires and `False` is returned.
-    * If the current timestamp is greater than the `expiry_timestamp`, the key
-      is considered expired and, it is deleted from the `DATASTORE`. `True` is
-      returned to indicate the expiration.
-    * Otherwise, the key is not expired and `False` is returned.
+    Records the expiry timestamp of a key that was just set.
+
+    Keys with an expiry are stored in `EXPIRIES`, and pushed to the
+    `expiry_heap`, so they are picked up by `actively_expire_keys` once their
+    expiry timestamp passes. If the key now expires before every other key,
+    `actively_expire_keys` is woken up to shorten its sleep. Keys without an
+    expiry (the default value) are not stored, and any expiry left over from a
+    previous value of the key is cleared.
     """
-    current_timestamp = int(time.time() * 1000)  # ms
     if expiry_timestamp == EXPIRY_TIMESTAMP_DEFAULT_VAL:
-        return False
-    elif current_timestamp > expiry_timestamp:
-        del DATASTORE[key]
-        return True
-    return False
+        EXPIRIES.pop(key, None)
+    else:
+        EXPIRIES[key] = expiry_timestamp
+        if not expiry_heap or expiry_timestamp < expiry_heap[0][0]:
+            expiry_wakeup.set()
+        heappush(expiry_heap, (expiry_timestamp, key))
+
+
+def lazy_free(value: Any):
+    """
+    Queues the value of a key that was just removed from the datastore, to be
+    dropped by `lazy_free_worker` instead of inline. Removing the dict entry
+    is O(1), but freeing a big value is not.
+    """
+    lazy_free_queue.append(value)
+    lazy_free_wakeup.set()
+
+
+async def lazy_free_worker():
+    """
+    Drops the values queued by `lazy_free`, `LAZY_FREE_BATCH_SIZE` at a time,
+    yielding to the event loop between batches so client commands are not
+    held up. Sleeps on `lazy_free_wakeup` while the queue is empty.
+    """
+    popleft = lazy_free_queue.popleft  # Local lookup in the loop below
+    while True:
+        while lazy_free_queue:
+            for _ in range(min(LAZY_FREE_BATCH_SIZE, len(lazy_free_queue))):
+                popleft()
+            await asyncio.sleep(0)
+        lazy_free_wakeup.clear()
+        await lazy_free_wakeup.wait()
 
 
-def get_expiry_timestamp(msg: list[str]) -> int:
+def get_expiry_timestamp(msg: list[bytes]) -> int:
     """
     Parses the provided RESP command message and extracts the optional key
     expiry timestamp.
@@ -72,15 +179,14 @@ def get_expiry_timestamp(msg: list[str]) -> int:
     absolute expiry time. Otherwise, it returns the default value indicating no
     active expiry.
     This function is used when setting keys to determine their valid lifespan
-    based on the provided command options.
+    based on the provided command options, by `replica_tasks` on the
+    replicas. It is inlined in `handle_set` on the master, keep both in sync.
     """
     if len(msg) > 3:
-        opt, expiry = msg[3], msg[4]
-        expiry = int(expiry)
-        if opt == "ex":  # seconds
+        opt, expiry = msg[3], int(msg[4])
+        if opt == b"ex":  # seconds
             expiry = expiry * 1000
-        current_timestamp = int(time.time() * 1000)  # ms
-        expiry_timestamp = current_timestamp + expiry
+        expiry_timestamp = cached_timestamp + expiry
     else:
         expiry_timestamp = EXPIRY_TIMESTAMP_DEFAULT_VAL
 
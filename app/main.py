@@ -1,25 +1,144 @@
-import argparse
 import asyncio
+import logging
 import os
+import sys
 from asyncio import IncompleteReadError, StreamReader, StreamWriter
 from collections import deque
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Process
+from queue import SimpleQueue
+from types import SimpleNamespace
+from typing import Awaitable, Callable
 
 from app.commands import (handle_config_get, handle_echo, handle_get,
                           handle_info, handle_list_keys, handle_ping,
                           handle_psync, handle_rdb_transfer, handle_replconf,
                           handle_set, handle_type, handle_wait, handle_xadd,
                           handle_xrange, handle_xread)
-from app.expiry import actively_expire_keys
-from app.replication import datastore, propagate_commands, replica_tasks
-from app.resp import RESPReader, RESPWriter
-from app.util import init_rdb_parser
+from app.expiry import (actively_expire_keys, clock_ticker, lazy_free_worker,
+                        set_key_expiry)
+from app.replication import (datastore, expiries, propagate_commands,
+                             replica_tasks, replication_wakeup)
+from app.resp import (BUFFER_SIZE, READ_LIMIT, ProtocolError, RESPReader,
+                      RESPWriter)
+from app.util import generate_random_string, init_rdb_parser
+
+try:
+    import uvloop  # type: ignore[import-not-found]
+except ImportError:  # Optional, the default asyncio event loop is used
+    uvloop = None
 
 role = "master"
+# Replication ID of this master, fixed for the lifetime of the process.
+master_replid = generate_random_string(40)
 ACTIVE_KEY_EXPIRY_TIME_WINDOW = 60  # seconds
+LISTEN_BACKLOG = 4096  # pending connections
 # Main Datastore, All SET, GET data is stored in this global dict.
 CONFIG: dict[str, str] = {}  # key -> value (Redis config parameters)
-replication_buffer: deque[str] = deque()
+# Commands to propagate to the replicas, emptied by `propagate_commands` every
+# time it wakes up with replicas attached. Until the first replica attaches,
+# it keeps every write, for that replica to replay on top of the empty RDB
+# sent by FULLRESYNC. It is unbounded, so no command is ever dropped.
+replication_buffer: deque[bytes] = deque()
 replicas: list[tuple[RESPReader, RESPWriter]] = []
+# Log every command received, enabled with `--debug`. Records are written out
+# by a `QueueListener` thread, not by the event loop.
+DEBUG = False
+# Named after the module explicitly, as `__name__` is "__main__" when run with
+# `python -m`, and its records have to reach the `app` package logger.
+logger = logging.getLogger("app.main")
+
+command_handler_type = Callable[[RESPWriter, list[bytes]], Awaitable[None]]
+# Handlers that only need the writer and the message, looked up with a single
+# dict access per command.
+COMMAND_TABLE: dict[bytes, command_handler_type] = {
+    b"PING": handle_ping,
+    b"ECHO": handle_echo,
+    b"TYPE": partial(handle_type, datastore=datastore),
+    b"GET": partial(handle_get, DATASTORE=datastore, EXPIRIES=expiries),
+    b"CONFIG": partial(handle_config_get, CONFIG=CONFIG),
+    b"KEYS": partial(handle_list_keys, DATASTORE=datastore),
+    b"REPLCONF": handle_replconf,
+    b"XADD": partial(handle_xadd, datastore=datastore),
+    b"XRANGE": handle_xrange,
+    b"XREAD": handle_xread,
+}
+
+
+class ConnectionState(object):
+    """
+    Per-connection state, handed to the handlers in `CONNECTION_COMMAND_TABLE`
+    by `handler`.
+    """
+
+    __slots__ = ("reader", "replication_offset", "lock", "is_replica")
+
+    def __init__(self, reader: RESPReader):
+        self.reader = reader
+        # Bytes of write commands propagated from this connection, that
+        # replicas have to acknowledge for WAIT.
+        self.replication_offset: int = 0
+        self.lock = asyncio.Lock()
+        # Set once the connection is handed over to replication by PSYNC.
+        self.is_replica = False
+
+
+async def set_command(
+    writer: RESPWriter, msg: list[bytes], state: ConnectionState
+):
+    await handle_set(writer, msg, datastore, expiries)
+    # Propagated as received, only re-serialized if it was read in pieces.
+    resp = state.reader.last_command or writer.serialize_array(msg)
+    state.replication_offset += len(resp)
+    replication_buffer.append(resp)
+    replication_wakeup.set()
+
+
+async def info_command(
+    writer: RESPWriter, msg: list[bytes], _: ConnectionState
+):
+    # `role` is only known once `main` has parsed the arguments.
+    await handle_info(writer, msg, role, master_replid)
+
+
+async def psync_command(
+    writer: RESPWriter, msg: list[bytes], state: ConnectionState
+):
+    await handle_psync(writer, msg, master_replid)
+    await handle_rdb_transfer(writer, msg)
+    replicas.append((state.reader, writer))
+    replication_wakeup.set()
+    state.is_replica = True
+
+
+async def wait_command(
+    writer: RESPWriter, msg: list[bytes], state: ConnectionState
+):
+    async with state.lock:
+        await handle_wait(writer, replicas, state.replication_offset, msg)
+
+
+connection_command_handler_type = Callable[
+    [RESPWriter, list[bytes], ConnectionState], Awaitable[None]
+]
+# Handlers that depend on per-connection replication state, or on the role.
+CONNECTION_COMMAND_TABLE: dict[bytes, connection_command_handler_type] = {
+    b"SET": set_command,
+    b"INFO": info_command,
+    b"PSYNC": psync_command,
+    b"WAIT": wait_command,
+}
+# Clients send command names in upper or lower case, register both so that
+# `handler` only has to call .upper() for mixed case names.
+COMMAND_TABLE.update({c.lower(): h for c, h in COMMAND_TABLE.items()})
+CONNECTION_COMMAND_TABLE.update(
+    {c.lower(): h for c, h in CONNECTION_COMMAND_TABLE.items()}
+)
+COMMAND_NAMES = frozenset(COMMAND_TABLE).union(CONNECTION_COMMAND_TABLE)
+# Commands propagated to the replicas, as received, for `set_command` to reuse
+# their raw bytes. Mixed case names are re-serialized instead.
+PROPAGATED_COMMANDS = frozenset((b"SET", b"set"))
 
 
 async def handler(stream_reader: StreamReader, stream_writer: StreamWriter):
@@ -29,92 +148,175 @@ async def handler(stream_reader: StreamReader, stream_writer: StreamWriter):
     following tasks in a loop:
     * Reads a single RESP message from the `stream_reader` using the
       `RESPReader`.
-    * Handles potential read errors by closing the connection and returning.
+    * Handles potential read errors by closing the connection and returning,
+      which is also how the end of the stream is detected.
     * Extracts the first element of the parsed message as the command name
-      (converted to uppercase).
-    * Matches the command name to known handlers, and executes the handler
-      function to perform the required operation.
+      (converted to uppercase, unless it already is in upper or lower case).
+    * Looks the command name up in `COMMAND_TABLE`, then in
+      `CONNECTION_COMMAND_TABLE`, and executes the handler function to
+      perform the required operation. Unknown commands end the connection.
+    * Flushes the buffered responses back to the client, once there are no
+      more pipelined commands already received, so replies to a batch of
+      pipelined commands go out in one write.
+    * Stops serving the connection once it was handed over to replication.
     """
-    reader, writer = RESPReader(stream_reader), RESPWriter(stream_writer)
-    replication_offset: int = 0
-
-    kv_store = init_rdb_parser(rdb_parser_required, rdb_file_path)
-    global datastore
-    datastore |= kv_store
-    # Union the parsed kv-store from the rdb file with our internal DATSTORE
-    lock = asyncio.Lock()
+    reader = RESPReader(stream_reader, raw_commands=PROPAGATED_COMMANDS)
+    writer = RESPWriter(stream_writer)
+    state = ConnectionState(reader)
 
-    while not stream_reader.at_eof():
+    while True:
         try:
             msg = await reader.read_message()
-            print(msg)
+            if DEBUG:
+                logger.debug("Received %r", msg)
         except (IncompleteReadError, ConnectionResetError) as err:
             print(err)
             await writer.close()
             return
-        command = msg[0].upper()
-        match command:
-            case "PING":
-                await handle_ping(writer)
-            case "ECHO":
-                await handle_echo(writer, msg)
-            case "TYPE":
-                await handle_type(writer, msg, datastore)
-            case "SET":
-                await handle_set(writer, msg, datastore)
-                resp = await writer.serialize_array(msg)
-                replication_offset += reader.get_byte_offset(msg)
-                replication_buffer.append(resp)
-            case "GET":
-                await handle_get(writer, msg, datastore)
-            case "CONFIG":
-                await handle_config_get(writer, msg, CONFIG)
-            case "KEYS":
-                await handle_list_keys(writer, msg, datastore)
-            case "INFO":
-                await handle_info(writer, msg, role)
-            case "REPLCONF":
-                await handle_replconf(writer, msg)
-            case "PSYNC":
-                await handle_psync(writer, msg)
-                await handle_rdb_transfer(writer, msg)
-                replicas.append((reader, writer))
-                return
-            case "WAIT":
-                async with lock:
-                    await handle_wait(
-                        writer, replicas, replication_offset, msg
-                    )
-            case "XADD":
-                await handle_xadd(writer, msg, datastore)
-            case "XRANGE":
-                await handle_xrange(writer, msg)
-            case "XREAD":
-                await handle_xread(writer, msg)
-            case _:
+        except ProtocolError as err:
+            # The framing is lost, nothing after this can be parsed.
+            writer.write_simple_error(f"ERR Protocol error: {err}")
+            await writer.close()
+            return
+        command = msg[0]
+        if command not in COMMAND_NAMES:
+            command = command.upper()
+        try:
+            command_handler = COMMAND_TABLE.get(command)
+            if command_handler is not None:
+                await command_handler(writer, msg)
+                continue
+            connection_command_handler = CONNECTION_COMMAND_TABLE.get(command)
+            if connection_command_handler is None:
                 print(f"Unknown command received : {command}")
+                await writer.flush()
                 return
+            await connection_command_handler(writer, msg, state)
+            if state.is_replica:
+                return
+        finally:
+            # Replies to pipelined commands that were already received are
+            # sent together, in a single write up to about BUFFER_SIZE.
+            if (
+                state.is_replica
+                or writer.buffer_len >= BUFFER_SIZE
+                or not reader.has_buffered_data()
+            ):
+                await writer.flush()
 
 
-async def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "--dir", type=str, help="The directory where RDB files are stored"
-    )
-    parser.add_argument(
-        "--dbfilename", type=str, help="The name of the RDB file"
-    )
-    parser.add_argument(
-        "--port", type=str, help="The port to which this instance will bind"
-    )
-    parser.add_argument(
-        "--replicaof", nargs=2, help="Specify the host and port"
+def start_logging() -> QueueListener:
+    """
+    Sends the records of the `app` package loggers (`app.main`,
+    `app.replication`, ...) through a queue to a `QueueListener`, whose
+    thread formats and writes them to stderr, so logging never blocks the
+    event loop on I/O.
+    """
+    queue: SimpleQueue = SimpleQueue()
+    listener = QueueListener(queue, logging.StreamHandler())
+    app_logger = logging.getLogger("app")
+    app_logger.addHandler(QueueHandler(queue))
+    app_logger.setLevel(logging.DEBUG)
+    listener.start()
+    return listener
+
+
+USAGE = (
+    "usage: python -m app.main [--dir DIR] [--dbfilename DBFILENAME] "
+    "[--port PORT] [--replicaof HOST PORT] [--workers WORKERS] [--debug]"
+)
+
+
+def _flag_values(argv: list[str], i: int, count: int) -> list[str]:
+    """
+    Returns the `count` values following the flag at `argv[i]`, or exits with
+    the usage message if the command line ends before them, or if one of them
+    is the next flag.
+    """
+    values = argv[i + 1 : i + 1 + count]
+    if len(values) < count or any(v.startswith("--") for v in values):
+        expected = "a value" if count == 1 else f"{count} values"
+        sys.exit(f"{USAGE}\n{argv[i]} expects {expected}")
+    return values
+
+
+def _int_flag_value(argv: list[str], i: int) -> int:
+    """
+    Returns the value following the flag at `argv[i]` as a positive integer,
+    or exits with the usage message if it isn't one.
+    """
+    value = _flag_values(argv, i, 1)[0]
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        sys.exit(f"{USAGE}\n{argv[i]} expects a positive integer : {value}")
+    return number
+
+
+def parse_args(argv: list[str]) -> SimpleNamespace:
+    """
+    Parses the command line flags with a single scan over `argv`, instead of
+    building an `argparse` parser at every process start. The known flags are:
+    * `--dir` and `--dbfilename`, the directory and name of the RDB file.
+    * `--port`, the port to which this instance will bind.
+    * `--replicaof`, the host and port of the master, either as two arguments
+      or as a single "<host> <port>" one.
+    * `--workers`, the number of server processes sharing the port. Each one
+      has its own datastore, so keys are sharded by connection.
+    * `--debug`, to log every command received.
+    A flag's value can also be given as "--flag=value", as with `argparse`.
+    """
+    argv = [
+        part
+        for arg in argv
+        for part in (arg.split("=", 1) if arg.startswith("--") else (arg,))
+    ]
+    args = SimpleNamespace(
+        dir=None,
+        dbfilename=None,
+        port=None,
+        replicaof=None,
+        workers=1,
+        debug=False,
     )
+    i = 0
+    while i < len(argv):
+        flag = argv[i]
+        match flag:
+            case "--dir" | "--dbfilename":
+                setattr(args, flag[2:], _flag_values(argv, i, 1)[0])
+                i += 2
+            case "--port":
+                args.port = _int_flag_value(argv, i)
+                i += 2
+            case "--replicaof":
+                if " " in _flag_values(argv, i, 1)[0]:
+                    args.replicaof = argv[i + 1].split()
+                    i += 2
+                else:
+                    args.replicaof = _flag_values(argv, i, 2)
+                    i += 3
+            case "--workers":
+                args.workers = _int_flag_value(argv, i)
+                i += 2
+            case "--debug":
+                args.debug = True
+                i += 1
+            case _:
+                sys.exit(f"{USAGE}\nUnknown argument : {flag}")
+    return args
+
+
+async def main(args: SimpleNamespace):
 
-    args = parser.parse_args()
+    if args.debug:
+        global DEBUG
+        DEBUG = True
+        start_logging()
 
     if args.dir and args.dbfilename:
-        global rdb_file_path, rdb_parser_required
         CONFIG["dir"] = dir = str(args.dir)
         CONFIG["dbfilename"] = filename = str(args.dbfilename)
         rdb_parser_required = True
@@ -123,33 +325,71 @@ async def main():
         rdb_file_path = ""
         rdb_parser_required = False
 
+    # Union the parsed kv-store from the rdb file with our internal DATSTORE,
+    # once at startup, and index its keys with an expiry for active expiry.
+    # Keys and values are encoded, as the datastore holds bytes.
+    kv_store, kv_expiries = init_rdb_parser(rdb_parser_required, rdb_file_path)
+    datastore.update(kv_store)
+    for key, expiry_timestamp in kv_expiries.items():
+        set_key_expiry(expiries, key, expiry_timestamp)
+
     host, port = "127.0.0.1", 6379
     if args.port:
-        port = int(args.port)
+        port = args.port
 
     if args.replicaof:
         global role
         role = "slave"
         master_host, master_port = args.replicaof
         reader, writer = await asyncio.open_connection(
-            master_host, master_port
+            master_host, master_port, limit=READ_LIMIT
         )
         asyncio.create_task(replica_tasks(reader, writer))
     else:
         asyncio.create_task(propagate_commands(replication_buffer, replicas))
+    asyncio.create_task(
+        actively_expire_keys(
+            datastore, expiries, ACTIVE_KEY_EXPIRY_TIME_WINDOW
+        )
+    )
+    asyncio.create_task(lazy_free_worker())
+    asyncio.create_task(clock_ticker())
 
-    server = await asyncio.start_server(handler, host, port, reuse_port=False)
+    # With several workers, every process binds the port, and the kernel
+    # spreads the incoming connections across them.
+    server = await asyncio.start_server(
+        handler,
+        host,
+        port,
+        backlog=LISTEN_BACKLOG,
+        reuse_port=args.workers > 1,
+        limit=READ_LIMIT,
+    )
     print(f"Started Redis server @ {host}:{port}")
 
     async with server:
         await server.serve_forever()
 
 
-if __name__ == "__main__":
+def run(args: SimpleNamespace):
     try:
-        asyncio.run(main())
-        asyncio.create_task(
-            actively_expire_keys(datastore, ACTIVE_KEY_EXPIRY_TIME_WINDOW)
-        )
+        if uvloop is not None:
+            uvloop.run(main(args))
+        else:
+            asyncio.run(main(args))
     except KeyboardInterrupt:
         print("Interrupted, shutting down.")
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.workers > 1:
+        workers = [
+            Process(target=run, args=(args,)) for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        run(args)
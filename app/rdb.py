@@ -1,16 +1,81 @@
+import mmap
+import struct
+
 from app.expiry import EXPIRY_TIMESTAMP_DEFAULT_VAL
 
+# Fixed width fields of the RDB format, unpacked straight from the mapping.
+UINT64_LE = struct.Struct("<Q")  # Expiry time in ms
+UINT32_LE = struct.Struct("<I")  # Expiry time in seconds
+UINT32_BE = struct.Struct(">I")  # 32 bit length
+# Integers encoded as strings, by their size in bytes.
+INT_AS_STRING = {
+    1: struct.Struct("<b"),
+    2: struct.Struct("<h"),
+    4: struct.Struct("<i"),
+}
+
+
+class RDBError(Exception):
+    """
+    Raised when the RDB file can't be parsed, it's truncated or not in the RDB
+    format.
+    """
+
+
+class EmptyRDBError(RDBError):
+    """
+    Raised when the RDB file is empty, there's nothing to map or parse.
+    """
+
 
 class RDBParser(object):
     def __init__(self, path: str):
         """
         Initializes the parser with the path to the RDB file.
-        Parses the entire file, and stores the key-value store as an object
-        variable.
+        Parses the entire file, and stores the key-value store, and the expiry
+        timestamps of the keys that have one, as object variables.
+
+        The file is memory-mapped once, and parsed through a `memoryview`
+        cursor (`pos`), so reads are slices of the mapping instead of calls
+        into a buffered file object. Raises `EmptyRDBError` for an empty file,
+        which can't be mapped, and `RDBError` for a file that can't be parsed.
         """
-        self.fhand = open(path, "rb")
-        magic_string = self._read_bytes(5).decode()
-        assert magic_string == "REDIS"  # Verify RDB file format
+        with open(path, "rb") as fhand:
+            try:
+                self.buf = mmap.mmap(
+                    fhand.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            except ValueError as err:  # Can't map an empty file
+                raise EmptyRDBError(f"Empty RDB file : {path}") from err
+        self.view = memoryview(self.buf)
+        self.pos = 0
+        try:
+            self._parse()
+        except (IndexError, KeyError, ValueError, struct.error) as err:
+            # Reads past the end of a truncated file, or unknown encodings.
+            raise RDBError(f"Invalid RDB file : {path} ({err})") from err
+        finally:
+            self._close()
+
+    def _close(self):
+        """
+        Releases the view and closes the mapping. If the parsing failed, views
+        sliced from the mapping may still be referenced by the traceback, in
+        which case they can't be released yet, and the mapping is closed once
+        they are garbage collected, instead of hiding the parsing error.
+        """
+        try:
+            self.view.release()
+            self.buf.close()
+        except BufferError:
+            pass
+
+    def _parse(self):
+        """
+        Parses the header fields, and the key-value store of the RDB file.
+        """
+        if self._read_bytes(5) != b"REDIS":  # Verify RDB file format
+            raise RDBError("Not an RDB file, no REDIS magic string")
 
         # Skip other header fields:
         self._read_bytes(4)  # version
@@ -20,19 +85,32 @@ class RDBParser(object):
         self.parse_length_encoded_int()  # Hash table size
         self.parse_length_encoded_int()  # Expiry table size
 
-        self.kv = self.parse_dict_w_expiry()
+        self.kv, self.expiries = self.parse_dict_w_expiry()
 
-    def _read_bytes(self, size: int) -> bytes:
+    def _read_bytes(self, size: int) -> memoryview:
         """
-        Reads a specified number of bytes from the RDB file.
+        Reads a specified number of bytes from the RDB file, as a view on the
+        mapping (no copy).
         """
-        return self.fhand.read(size)
+        pos = self.pos
+        self.pos = pos + size
+        return self.view[pos : pos + size]
 
-    def _peek_bytes(self) -> bytes:
+    def _peek_bytes(self) -> memoryview:
         """
         Peeks at the next byte in the RDB file without consuming it.
         """
-        return self.fhand.peek(1)
+        return self.view[self.pos : self.pos + 1]
+
+    def _unpack(self, fmt: struct.Struct) -> int:
+        """
+        Unpacks a fixed width integer from the RDB file, without slicing the
+        bytes out of the mapping first.
+        """
+        pos = self.pos
+        self.pos = pos + fmt.size
+        value: int = fmt.unpack_from(self.view, pos)[0]
+        return value
 
     def parse_length_encoded_int(self) -> tuple[bool, int]:
         """
@@ -41,69 +119,52 @@ class RDBParser(object):
         returned. If the bits are 11, it denotes a special format, and is used
         for string encodings.
         The number of bits are used to consume that many bytes for the string.
+
+        The encoding bits are the top two bits of the first byte, taken with a
+        shift and a mask, rather than by formatting the byte as a string.
         """
         determinant = self._read_bytes(1)[0]
-        determinant_bits = bin(determinant)[2:].zfill(8)
-
-        special_format = False
-        match determinant_bits[:2]:
-            case "00":
-                length = determinant & 0b00111111
-            case "01":
-                next_byte = self._read_bytes(1)[0]
-                first_byte = determinant & 0b00111111
-                length = (first_byte << 8) | next_byte
-            case "10":
-                length = int.from_bytes(self._read_bytes(4), byteorder="big")
-            case "11":
-                # The next object is encoded in a special format.
-                # The remaining 6 bits indicate the format.
-                format = determinant & 0b00111111
-                special_format = True
-                match int(format):
-                    case 0:
-                        length = 1
-                    case 1:
-                        length = 2
-                    case 2:
-                        length = 4
-                    case 3:
-                        # Compressed string follows, Not implemented.
-                        length = -1
-                    case _:
-                        raise ValueError(
-                            "Unknown format for Length Encoded Int case '11'"
-                            f" : {int(format)}"
-                        )
-            case _:
-                raise ValueError(
-                    "Unknown encoding for Length Encoded Int :"
-                    f" {determinant_bits[2:]}"
-                )
+        tag = determinant >> 6
+        low = determinant & 0b00111111
+        if tag == 0:
+            return False, low
+        if tag == 1:
+            return False, (low << 8) | self._read_bytes(1)[0]
+        if tag == 2:
+            return False, self._unpack(UINT32_BE)
+        # The next object is encoded in a special format.
+        # The remaining 6 bits indicate the format.
+        if low < 3:
+            return True, 1 << low  # 1, 2 or 4 byte integer
+        if low == 3:
+            # Compressed string follows, Not implemented.
+            return True, -1
+        raise ValueError(
+            f"Unknown format for Length Encoded Int case '11' : {low}"
+        )
 
-        return special_format, length
-
-    def parse_encoded_string(self) -> str:
+    def parse_encoded_string(self) -> bytes:
         """
         Parses an encoded string from the RDB file. Uses the
         parse_length_encoded_int to get the length of the string. And a bool
         denoting if special format is used or not.
+
+        The string is returned as bytes, like the keys and values in the
+        datastore, so it is never decoded.
         """
         special_format, length = self.parse_length_encoded_int()
         if not special_format:
-            return self._read_bytes(length).decode()
+            return bytes(self._read_bytes(length))
         else:
-            # This is the "Integers as String" path
-            return str(
-                int.from_bytes(self._read_bytes(length), byteorder="big")
-            )
+            # This is the "Integers as String" path, stored little-endian.
+            return b"%d" % self._unpack(INT_AS_STRING[length])
 
-    def parse_simple_dict(self) -> dict[str, str]:
+    def parse_simple_dict(self) -> dict[bytes, bytes]:
         """
         Parses a simple dictionary from the RDB file, where keys and values are
         strings.
         """
-        d: dict[str, str] = {}
+        d: dict[bytes, bytes] = {}
         while self._peek_bytes()[:1] == b"\xfa":
             self._read_bytes(1)  # Skip
             key = self.parse_encoded_string()
@@ -111,30 +172,36 @@ class RDBParser(object):
             d[key] = value
         return d
 
-    def parse_dict_w_expiry(self):
+    def parse_dict_w_expiry(
+        self,
+    ) -> tuple[dict[bytes, bytes], dict[bytes, int]]:
         """
         Parses a dictionary along with expiry information from the RDB file.
+        Returns the values, and the expiry timestamps of only the keys that
+        have one, as two separate dicts (the layout of the datastore).
         """
-        d: dict[str, tuple[str, int]] = {}  # key -> (value, expiry_timestamp)
-        while self._peek_bytes()[:1] != b"\xff":
-            if self._peek_bytes()[:1] == b"\xfc":
+        d: dict[bytes, bytes] = {}  # key -> value
+        expiries: dict[bytes, int] = {}  # key -> expiry_timestamp
+        while True:
+            # A single read of the opcode, it's the value type if the entry
+            # has no expiry.
+            opcode = self._read_bytes(1)[0]
+            if opcode == 0xFF:  # End of the RDB file
+                break
+            if opcode == 0xFC:
                 # "expiry time in ms", followed by 8 byte unsigned long
-                self._read_bytes(1)  # Skip
-                expiry = int.from_bytes(
-                    self._read_bytes(8), byteorder="little"
-                )
-            elif self._peek_bytes()[:1] == b"\xfd":
+                expiry = self._unpack(UINT64_LE)
+                self._read_bytes(1)  # value_type
+            elif opcode == 0xFD:
                 # "expiry time in seconds", followed by 4 byte unsigned int
-                self._read_bytes(1)  # Skip
-                expiry = (
-                    int.from_bytes(self._read_bytes(4), byteorder="little")
-                    * 1000
-                )
+                expiry = self._unpack(UINT32_LE) * 1000
+                self._read_bytes(1)  # value_type
             else:
                 expiry = EXPIRY_TIMESTAMP_DEFAULT_VAL
-            _ = self._read_bytes(1)  # value_type
             key = self.parse_encoded_string()
             value = self.parse_encoded_string()
-            d[key] = (value, expiry)
+            d[key] = value
+            if expiry != EXPIRY_TIMESTAMP_DEFAULT_VAL:
+                expiries[key] = expiry
 
-        return d
+        return d, expiries
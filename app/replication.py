@@ -1,54 +1,115 @@
-from asyncio import IncompleteReadError, StreamReader, StreamWriter, sleep
+import asyncio
+import logging
+from asyncio import IncompleteReadError, StreamReader, StreamWriter
 from collections import deque
 from typing import Any
 
-from app.expiry import get_expiry_timestamp
-from app.resp import RESPReader, RESPWriter
+from app.expiry import get_expiry_timestamp, set_key_expiry
+from app.resp import ProtocolError, RESPReader, RESPWriter
 
-datastore: dict[str, tuple[Any, int]] = {}  # key -> (value, expiry_timestamp)
+# key -> value, both kept as the bytes received from clients.
+datastore: dict[bytes, Any] = {}
+# key -> expiry_timestamp, only for the keys that were set with a TTL.
+expiries: dict[bytes, int] = {}
+# Set whenever a command is added to the replication buffer, or a replica is
+# added, so `propagate_commands` only wakes up when there is work to do.
+replication_wakeup = asyncio.Event()
+
+logger = logging.getLogger(__name__)
+
+# Handshake commands sent to the master, and the prefix of the replies to its
+# REPLCONF GETACK, serialized once.
+PING = b"*1\r\n$4\r\nPING\r\n"
+REPLCONF_LISTENING_PORT = (
+    b"*3\r\n$8\r\nREPLCONF\r\n$14\r\nlistening-port\r\n$4\r\n6380\r\n"
+)
+REPLCONF_CAPA = (
+    b"*5\r\n$8\r\nREPLCONF\r\n$4\r\ncapa\r\n$6\r\npsync2\r\n"
+    b"$4\r\ncapa\r\n$6\r\npsync2\r\n"
+)
+PSYNC = b"*3\r\n$5\r\nPSYNC\r\n$1\r\n?\r\n$2\r\n-1\r\n"
+REPLCONF_ACK_PREFIX = b"*3\r\n$8\r\nREPLCONF\r\n$3\r\nACK\r\n"
+# Sent by the master to ask replicas for their offset.
+REPLCONF_GETACK = b"*3\r\n$8\r\nREPLCONF\r\n$6\r\nGETACK\r\n$1\r\n*\r\n"
 
 
 async def replication_handshake(reader: RESPReader, writer: RESPWriter):
     """ """
-    ping = ["PING"]
-    await writer.write_array(ping)
+    writer.write_raw(PING)
+    await writer.flush()
     data = await reader.read_simple_string()
-    print(data)
+    logger.debug("Handshake reply %r", data)
 
-    replconf = ["REPLCONF", "listening-port", "6380"]
-    await writer.write_array(replconf)
+    writer.write_raw(REPLCONF_LISTENING_PORT)
+    await writer.flush()
     data = await reader.read_simple_string()
-    print(data)
+    logger.debug("Handshake reply %r", data)
 
-    replconf_capa = ["REPLCONF", "capa", "psync2", "capa", "psync2"]
-    await writer.write_array(replconf_capa)
+    writer.write_raw(REPLCONF_CAPA)
+    await writer.flush()
     data = await reader.read_simple_string()
-    print(data)
+    logger.debug("Handshake reply %r", data)
 
-    replconf_capa = ["PSYNC", "?", "-1"]
-    await writer.write_array(replconf_capa)
+    writer.write_raw(PSYNC)
+    await writer.flush()
     data = await reader.read_simple_string()
-    print(data)
+    logger.debug("Handshake reply %r", data)
 
     rdb = await reader.read_rdb()
-    print(rdb)
+    logger.debug("Received RDB of %d bytes", len(rdb))
 
     return
 
 
+async def flush_replicas(replicas: list[tuple[RESPReader, RESPWriter]]):
+    """
+    Flushes the write buffers of all the `replicas` concurrently.
+
+    A replica whose connection is gone is removed from `replicas` and closed,
+    so a single disconnected replica doesn't fail the flush of the others, nor
+    every later one.
+    """
+    results = await asyncio.gather(
+        *(w.flush() for _, w in replicas), return_exceptions=True
+    )
+    dead = [
+        replica
+        for replica, result in zip(list(replicas), results)
+        if isinstance(result, ConnectionError)
+    ]
+    for replica in dead:
+        logger.debug("Dropping disconnected replica %r", replica[1])
+        replicas.remove(replica)
+        await replica[1].close()
+    for result in results:
+        if isinstance(result, BaseException) and not isinstance(
+            result, ConnectionError
+        ):
+            raise result
+
+
 async def propagate_commands(
-    replication_buffer: deque[str],
+    replication_buffer: deque[bytes],
     replicas: list[tuple[RESPReader, RESPWriter]],
 ):
-    WAIT_TIME = 0.125  # seconds
+    """
+    Sends the commands in `replication_buffer` to every replica.
+
+    Sleeps on `replication_wakeup` until commands are buffered, then sends
+    everything buffered so far as one write per replica, and flushes all the
+    replicas concurrently with `flush_replicas`, which drops the replicas that
+    disconnected. Commands stay buffered until the first replica is added.
+    """
     while True:
-        if len(replicas) != 0:
-            if len(replication_buffer) != 0:
-                cmd = replication_buffer.popleft()
-                for replica in replicas:
-                    _, w = replica
-                    await w.write(cmd)
-        await sleep(WAIT_TIME)
+        await replication_wakeup.wait()
+        replication_wakeup.clear()
+        if not replicas or not replication_buffer:
+            continue
+        batch = b"".join(replication_buffer)
+        replication_buffer.clear()
+        for _, w in replicas:
+            w.write_raw(batch)
+        await flush_replicas(replicas)
 
 
 async def replica_tasks(
@@ -61,27 +122,30 @@ async def replica_tasks(
     global datastore
     offset = 0  # Count of processed bytes
     while True:
+        start = reader.bytes_read
         try:
             msg = await reader.read_message()
-            print("Received from master :", msg)
-        except (IncompleteReadError, ConnectionResetError) as err:
+        except (
+            IncompleteReadError,
+            ConnectionResetError,
+            ProtocolError,
+        ) as err:
             print(err)
             await writer.close()
             return
         command = msg[0].upper()
         match command:
-            case "SET":
+            case b"SET":
                 key, value = msg[1], msg[2]
-                datastore[key] = (
-                    value,
-                    get_expiry_timestamp([]),
-                )  # No active expiry
-            case "REPLCONF":
+                expiry_timestamp = get_expiry_timestamp(msg)
+                datastore[key] = value
+                set_key_expiry(expiries, key, expiry_timestamp)
+            case b"REPLCONF":
                 # Master won't send any other REPLCONF message apart from
                 # GETACK.
-                response = ["REPLCONF", "ACK", str(offset)]
-                await writer.write_array(response)
+                ack_offset = writer.serialize_bulk_string(b"%d" % offset)
+                writer.write_raw(REPLCONF_ACK_PREFIX + ack_offset)
+                await writer.flush()
             case _:
                 pass
-        bytes_to_process = reader.get_byte_offset(msg)
-        offset += bytes_to_process
+        offset += reader.bytes_read - start
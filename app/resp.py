@@ -1,5 +1,45 @@
 from asyncio import StreamReader, StreamWriter
-from typing import Any, Optional
+from typing import Any, Callable, Collection, Optional, Union
+
+# Initial size of the per-connection write buffer, and the size it is shrunk
+# back to after a flush if a large reply made it grow past MAX_BUFFER_SIZE.
+BUFFER_SIZE = 4096  # bytes
+MAX_BUFFER_SIZE = 1 << 20  # bytes
+# Limit of the `StreamReader`s given to `RESPReader`, instead of the default
+# 64 KiB, so large pipelines are buffered without pausing the transport, and
+# lines that long are accepted by `readuntil`.
+READ_LIMIT = 1 << 20  # bytes
+# Replies that never change, serialized once.
+PONG = b"+PONG\r\n"
+OK = b"+OK\r\n"
+NULL_BULK = b"$-1\r\n"
+# Payloads at least this large are read without their trailing CRLF, and the
+# CRLF separately, instead of being copied once more to trim it.
+LARGE_PAYLOAD_SIZE = 1 << 16  # bytes
+# Integer replies for common small integers (counts, offsets, -1 and 0/1),
+# serialized once, indexed with the integer + 1.
+MIN_CACHED_INTEGER, MAX_CACHED_INTEGER = -1, 1024
+INTEGER_REPLIES = tuple(
+    b":%d\r\n" % i for i in range(MIN_CACHED_INTEGER, MAX_CACHED_INTEGER + 1)
+)
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the bytes received do not follow the RESP framing, after which
+    the rest of the stream can't be parsed, and the connection is closed.
+    """
+
+
+def parse_integer(data: Union[bytes, bytearray]) -> int:
+    """
+    Parses the integer of a RESP length header or integer message, raising
+    `ProtocolError` instead of `ValueError` if `data` isn't one.
+    """
+    try:
+        return int(data)
+    except ValueError:
+        raise ProtocolError(f"Invalid integer : {bytes(data)!r}") from None
 
 
 class RESPReader(object):
@@ -13,52 +53,144 @@ class RESPReader(object):
     suitability for real-time applications.
     """
 
-    def __init__(self, reader: StreamReader):
+    def __init__(
+        self,
+        reader: StreamReader,
+        raw_commands: frozenset[bytes] = frozenset(),
+    ):
         """
         Initializes the `RESPReader` instance with the provided `reader`
-        object.
+        object, expected to be created with a `limit` of `READ_LIMIT`.
+        `raw_commands` are the names of the commands whose raw bytes are kept
+        in `last_command`.
         """
         self.reader = reader
+        self.raw_commands = raw_commands
+        # The raw bytes of the last message, if it was one of `raw_commands`
+        # parsed by `parse_buffered_command`, so it can be propagated as
+        # received. Other commands aren't copied a second time.
+        self.last_command: Optional[bytes] = None
+        # Count of the bytes read from the stream so far, replicas use it to
+        # track their replication offset.
+        self.bytes_read = 0
 
-    def get_byte_offset(self, message: list[str]) -> int:
-        # Returns the byte offset for a RESP command
-        # To be used only with RESP Arrays
-        offset = 0
-        offset += 2 * (2 * len(message) + 1)
-        offset += len(str(len(message))) + 1
-        for _, val in enumerate(message):
-            msg_len = len(val)
-            offset += len(str(msg_len)) + 1
-            offset += msg_len
-        return offset
+    def has_buffered_data(self) -> bool:
+        """
+        Returns whether more bytes were already received from the stream, and
+        can be read without waiting on the connection.
+        """
+        return bool(self._stream_buffer())
+
+    def _stream_buffer(self) -> bytearray:
+        """
+        Returns the bytes received by the stream that were not read yet.
+
+        This depends on CPython's asyncio internals: `StreamReader` keeps them
+        in its private `_buffer` bytearray (uvloop uses the same
+        `StreamReader`). It is the only place that attribute is accessed.
+        """
+        return self.reader._buffer  # type: ignore[attr-defined]
+
+    def _consume_stream_buffer(self, n: int):
+        """
+        Drops the first `n` bytes of `_stream_buffer`, once they were parsed.
+
+        Like `_stream_buffer`, this depends on CPython's asyncio internals: it
+        calls the private `StreamReader._maybe_resume_transport` as the
+        `StreamReader` reads do, so that a paused transport reads again.
+        """
+        del self._stream_buffer()[:n]
+        self.reader._maybe_resume_transport()  # type: ignore[attr-defined]
+
+    def parse_buffered_command(self) -> Optional[list[bytes]]:
+        """
+        Parses a client command, a RESP array of bulk strings, straight out of
+        the bytes the stream has already received, without awaiting.
+
+        Pipelined commands are all received before they are read, so most
+        commands are parsed here in one go, instead of with one coroutine step
+        per line like `read_array`. If the buffered bytes do not start with a
+        complete command (or hold null elements), nothing is consumed and
+        `None` is returned, for `read_message` to take the streaming path.
+        The raw bytes of a parsed command are kept in `last_command`, if it is
+        one of `raw_commands`. A bulk string not followed by CRLF raises
+        `ProtocolError`.
+        """
+        buffer = self._stream_buffer()
+        if not buffer or buffer[0] != 0x2A:  # "*"
+            return None
+        end = buffer.find(b"\r\n", 1)
+        if end == -1:
+            return None
+        # A header that isn't an integer is left to the streaming path, which
+        # raises `ProtocolError` for it, so `int` isn't wrapped per header.
+        try:
+            length = int(buffer[1:end])
+            pos = end + 2
+            arr: list[bytes] = []
+            for _ in range(length):
+                if buffer[pos : pos + 1] != b"$":
+                    return None
+                end = buffer.find(b"\r\n", pos + 1)
+                if end == -1:
+                    return None
+                size = int(buffer[pos + 1 : end])
+                if size < 0:
+                    return None
+                start = end + 2
+                pos = start + size + 2
+                if pos > len(buffer):
+                    return None
+                if buffer[pos - 2 : pos] != b"\r\n":
+                    raise ProtocolError("Bulk string not terminated by CRLF")
+                arr.append(bytes(buffer[start : start + size]))
+        except ValueError:
+            return None
+        if arr and arr[0] in self.raw_commands:
+            self.last_command = bytes(buffer[:pos])
+        self.bytes_read += pos
+        self._consume_stream_buffer(pos)
+        return arr
 
     async def read_message(self) -> Any:
         """
         Reads and parses a single RESP message from the underlying stream.
 
-        This method first reads one byte to identify the message type based on
-        the RESP protocol encoding. It then delegates the actual parsing to the
-        appropriate internal function based on the identified type.
-        """
-        msg_code = (await self.reader.readexactly(1)).decode()
-        match msg_code:
-            case "+":  # Simple String
-                string = await self.read_simple_string()
-                return string
-            case "-":  # Simple Error
-                err = await self.read_simple_error()
-                return err
-            case ":":  # Integer
-                num = await self.read_integer()
-                return num
-            case "$":  # Bulk String
-                string = await self.read_bulk_string()
-                return string
-            case "*":  # Array
-                arr = await self.read_array()
-                return arr
-            case _:
-                raise RuntimeError(f"Unknown payload identifier : {msg_code}")
+        Commands that were already fully received are parsed synchronously
+        by `parse_buffered_command`. Otherwise, this method reads the first
+        line of the message, whose first byte identifies the message type
+        based on the RESP protocol encoding, and hands it to `read_payload`.
+        """
+        self.last_command = None
+        command = self.parse_buffered_command()
+        if command is not None:
+            return command
+        line = await self.read_line_bytes()
+        return await self.read_payload(line)
+
+    async def read_payload(self, line: bytes) -> Any:
+        """
+        Parses a RESP message, whose first line `line` (without its CRLF) was
+        already read.
+
+        The type byte and the value of the message come in a single line, so
+        they are read together. Simple strings, errors and integers are parsed
+        from the line itself, with the parsing function of their type in
+        `SCALAR_PARSERS`. Bulk strings and arrays read their content from the
+        stream.
+        """
+        msg_code = line[0] if line else -1
+        if msg_code == 0x24:  # "$", Bulk String
+            length = parse_integer(line[1:])
+            if length == -1:
+                return None
+            return await self.read_until(length + 2)
+        if msg_code == 0x2A:  # "*", Array
+            return await self.read_array_elements(parse_integer(line[1:]))
+        parser = SCALAR_PARSERS.get(msg_code)
+        if parser is None:
+            raise ProtocolError(f"Unknown payload identifier : {line[:1]!r}")
+        return parser(line[1:])
 
     async def read_array(
         self, skip_first_byte: bool = False
@@ -68,22 +200,45 @@ class RESPReader(object):
 
         This method assumes the identifier byte has already been identified as
         the indicator for an array message. It then reads the number of
-        elements in the array and parses each element individually using
-        `read_message()`.
+        elements in the array and parses them with `read_array_elements`.
         """
-        arr: list[Any] = []
+        metadata = await self.read_line_bytes()
         if skip_first_byte:
-            await self.read_until(1)
+            metadata = metadata[1:]
+        return await self.read_array_elements(parse_integer(metadata))
+
+    async def read_array_elements(self, length: int) -> Optional[list[Any]]:
+        """
+        Reads and parses the `length` elements of a RESP array.
 
-        metadata = await self.read_line()
-        if not metadata:
-            return arr
-        length = int(metadata)
+        The first line of every element is read with a single `readuntil`.
+        Bulk strings, which is what commands are made of, are read right here
+        from the stream, other elements are parsed with `read_payload`.
+        """
         if length == -1:
             return None
+        arr: list[Any] = []
+        reader = self.reader
         for _ in range(length):
-            msg = await self.read_message()
-            arr.append(msg)
+            line = await reader.readuntil(b"\r\n")
+            if line[0] != 0x24:  # "$"
+                self.bytes_read += len(line)
+                arr.append(await self.read_payload(line[:-2]))
+                continue
+            size = parse_integer(line[1:-2])
+            if size == -1:
+                self.bytes_read += len(line)
+                arr.append(None)
+                continue
+            if size + 2 >= LARGE_PAYLOAD_SIZE:
+                self.bytes_read += len(line)
+                arr.append(await self.read_until(size + 2))
+                continue
+            data = await reader.readexactly(size + 2)
+            self.bytes_read += len(line) + size + 2
+            if data[-2:] != b"\r\n":
+                raise ProtocolError("Bulk string not terminated by CRLF")
+            arr.append(data[:-2])
         return arr
 
     async def read_simple_string(self) -> str:
@@ -116,20 +271,20 @@ class RESPReader(object):
         the indicator for an integer. It then reads the remaining bytes
         representing the integer value and converts it to a Python integer.
         """
-        data = await self.read_line()
-        return int(data)
+        data = await self.read_line_bytes()
+        return parse_integer(data)
 
-    async def read_bulk_string(self) -> Optional[str]:
+    async def read_bulk_string(self) -> Optional[bytes]:
         """
         Reads and parses a RESP bulk string message from the stream.
 
         This method assumes the identifier byte has already been identified as
         the indicator for a bulk string. It then reads the length of the string
-        data and reads the actual bytes.
+        data and reads the actual bytes, which are returned as is (keys and
+        values are stored as bytes, so they are never decoded).
         """
-        metadata = await self.read_line()
-        # print(metadata)
-        length = int(metadata)
+        metadata = await self.read_line_bytes()
+        length = parse_integer(metadata)
         if length == -1:
             return None
         string = await self.read_until(length + 2)
@@ -142,25 +297,47 @@ class RESPReader(object):
         """
         Reads a single RESP line message from the stream.
 
+        This method reads the line with `read_line_bytes` and decodes it using
+        the default encoding.
+        """
+        data = await self.read_line_bytes()
+        return data.decode()
+
+    async def read_line_bytes(self) -> bytes:
+        """
+        Reads a single RESP line from the stream, as bytes.
+
         This method reads bytes from the underlying stream until it encounters
-        a CRLF character (`b"\r\n"`). It then trims the trailing CRLF
-        characters (`\r\n`) and decodes the remaining bytes using the default
-        encoding.
+        a CRLF character (`b"\r\n"`), and trims the trailing CRLF characters.
+        Lengths and integers are parsed from these bytes directly, as `int`
+        accepts them, without decoding them to a string first.
         """
         data = await self.reader.readuntil(b"\r\n")
-        return data[:-2].decode()
+        self.bytes_read += len(data)
+        return data[:-2]
 
-    async def read_until(self, n: int) -> str:
+    async def read_until(self, n: int) -> bytes:
         """
         Reads a specific number of bytes from the stream.
 
         This method directly calls the `readexactly` method of the underlying
         stream reader and expects an exact number of bytes (`n`) to be
-        provided. It then trims the trailing newline characters (`\r\n`) and
-        decodes the remaining bytes using the default encoding.
-        """
-        data = await self.reader.readexactly(n)
-        return data[:-2].decode()
+        provided. It then trims the trailing newline characters (`\r\n`). For
+        large payloads, the newline characters are read on their own instead,
+        so the payload isn't copied again by the trim. Raises `ProtocolError`
+        if the data doesn't end with the newline characters.
+        """
+        self.bytes_read += n
+        if n < LARGE_PAYLOAD_SIZE:
+            data = await self.reader.readexactly(n)
+            crlf = data[-2:]
+            data = data[:-2]
+        else:
+            data = await self.reader.readexactly(n - 2)
+            crlf = await self.reader.readexactly(2)
+        if crlf != b"\r\n":
+            raise ProtocolError("Bulk string not terminated by CRLF")
+        return data
 
     async def read_rdb(self) -> bytes:
         """
@@ -172,21 +349,37 @@ class RESPReader(object):
         decodes the remaining bytes using the default encoding.
         """
         _ = await self.reader.readexactly(1)
-        line = await self.read_line()
-        length = int(line)
+        self.bytes_read += 1
+        line = await self.read_line_bytes()
+        length = parse_integer(line)
         if length == -1:
             return b""
         data = await self.reader.readexactly(length)
+        self.bytes_read += length
         return data
 
 
+# Parsing function of the RESP messages that fit in their first line, by their
+# identifier byte.
+SCALAR_PARSERS: dict[int, Callable[[bytes], Any]] = {
+    0x2B: bytes.decode,  # "+", Simple String
+    0x2D: bytes.decode,  # "-", Simple Error
+    0x3A: parse_integer,  # ":", Integer
+}
+
+
 class RESPWriter(object):
     """
     A class for serializing and writing RESP commands for sending responses to
     Redis clients.
 
     The writer utilizes an underlying `StreamWriter` object to write byte
-    encoded messages based on the given data and desired RESP type.
+    encoded messages based on the given data and desired RESP type. Messages
+    are collected in an internal buffer, and only sent to the stream, in a
+    single write, when `flush` is called. The buffer is allocated once per
+    connection and reused across flushes, `buffer_len` tracks how much of it
+    is filled. The `serialize_*` methods are plain functions, as they only
+    build bytes and never wait on the stream.
     """
 
     def __init__(self, writer: StreamWriter):
@@ -195,129 +388,183 @@ class RESPWriter(object):
         object.
         """
         self.writer = writer
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.buffer_len = 0
 
-    async def serialize_array(self, arr: list[Any]) -> str:
+    def serialize_array(self, arr: Collection[Any]) -> bytes:
         """
-        Serializes a list of data elements into a RESP array encoded message.
+        Serializes a collection of data elements into a RESP array encoded
+        message.
 
-        This method iterates through the provided list and serializes each
-        element based on its type (string, integer, or nested array) using the
-        corresponding helper functions (`serialize_simple_string`,
-        `serialize_integer`, or recursively calling `serialize_array`). The
-        final message is prefixed with the RESP array code ("*") and the length
-        of the array.
+        This method iterates through the provided collection and serializes
+        each element, appending it to a single `bytearray`. Bulk strings, the
+        most common elements, are formatted right in the loop, any other
+        element goes through `serialize_array_element`. The final message is
+        prefixed with the RESP array code ("*") and the length of the array.
         """
-        MSG_CODE, DELIMITER = "*", "\r\n"
-        response = ""
-        response += MSG_CODE + str(len(arr)) + DELIMITER
+        response = bytearray(b"*%d\r\n" % len(arr))
         for obj in arr:
-            if type(obj) is str:
-                response += await self.serialize_bulk_string(obj)
-            elif type(obj) is int:
-                response += await self.serialize_integer(obj)
-            elif type(obj) is list:
-                response += await self.serialize_array(obj)
-        return response
+            if type(obj) is bytes and obj:
+                response += b"$%d\r\n%b\r\n" % (len(obj), obj)
+            else:
+                response += self.serialize_array_element(obj)
+        return bytes(response)
+
+    def serialize_array_element(self, obj: Any) -> bytes:
+        """
+        Serializes a single element of a RESP array based on its type (bytes,
+        string or null, integer, or nested array) using the corresponding
+        helper functions (`serialize_bulk_string`, `serialize_integer`, or
+        `serialize_array`).
+        """
+        serializer = ELEMENT_SERIALIZERS.get(type(obj))
+        if serializer is None:
+            raise TypeError(f"Cannot serialize {type(obj).__name__} to RESP")
+        return serializer(self, obj)
 
-    async def serialize_simple_string(self, data: str) -> str:
+    def serialize_simple_string(self, data: str) -> bytes:
         """
         Serializes a string into a RESP simple string encoded message.
         """
-        MSG_CODE, DELIMITER = "+", "\r\n"
-        message = MSG_CODE + data + DELIMITER
-        return message
+        return b"+%b\r\n" % data.encode()
 
-    async def serialize_simple_error(self, data: str) -> str:
+    def serialize_simple_error(self, data: str) -> bytes:
         """
         Serializes a string into a RESP simple error encoded message.
         """
-        MSG_CODE, DELIMITER = "-", "\r\n"
-        message = MSG_CODE + data + DELIMITER
-        return message
+        return b"-%b\r\n" % data.encode()
 
-    async def serialize_integer(self, data: int) -> str:
+    def serialize_integer(self, data: int) -> bytes:
         """
         Serializes an integer into a RESP integer encoded message.
+        Small integers are looked up in `INTEGER_REPLIES` instead.
         """
-        MSG_CODE, DELIMITER = ":", "\r\n"
-        message = MSG_CODE + str(data) + DELIMITER
-        return message
+        if MIN_CACHED_INTEGER <= data <= MAX_CACHED_INTEGER:
+            return INTEGER_REPLIES[data - MIN_CACHED_INTEGER]
+        return b":%d\r\n" % data
 
-    async def serialize_bulk_string(self, data: Optional[str]) -> str:
+    def serialize_bulk_string(self, data: Optional[bytes | str]) -> bytes:
         """
-        Serializes a string into a RESP bulk string encoded message.
+        Serializes bytes, or a string, into a RESP bulk string encoded message.
 
         This method checks for null bulk strings (represented by `None`) and
         encodes them with a special code ("$-1\r\n"). Otherwise, it prefixes
-        the string length with the RESP bulk string code ("$") and appends the
-        string data and a newline delimiter ("\r\n").
+        the data length with the RESP bulk string code ("$") and appends the
+        data and a newline delimiter ("\r\n"). Strings are encoded first,
+        bytes (keys and values) are used as is.
         """
-        MSG_CODE, DELIMITER = "$", "\r\n"
         if not data:  # Null bulk strings
-            message = "$-1\r\n"
-        else:
-            message = MSG_CODE + str(len(data)) + DELIMITER + data + DELIMITER
-        return message
+            return NULL_BULK
+        encoded = data.encode() if isinstance(data, str) else data
+        return b"$%d\r\n%b\r\n" % (len(encoded), encoded)
 
-    async def write_array(self, arr: list[Any]):
+    def write_array(self, arr: Collection[Any]):
         """
-        Writes a RESP array encoded message to the underlying stream.
+        Writes a RESP array encoded message to the write buffer.
+
+        Any sized collection is accepted (e.g. `dict.keys()`), and its elements
+        are serialized into the buffer one at a time, so the collection is
+        never copied into an intermediate list or message string. As in
+        `serialize_array`, bulk strings are formatted right in the loop.
         """
-        message = await self.serialize_array(arr)
-        await self.write(message)
+        self._append_to_buffer(b"*%d\r\n" % len(arr))
+        for obj in arr:
+            if type(obj) is bytes and obj:
+                self._append_to_buffer(b"$%d\r\n%b\r\n" % (len(obj), obj))
+            else:
+                self._append_to_buffer(self.serialize_array_element(obj))
 
-    async def write_simple_string(self, data: str):
+    def write_simple_string(self, data: str):
         """
         Writes a RESP simple string encoded message to the underlying stream.
         """
-        message = await self.serialize_simple_string(data)
-        await self.write(message)
+        message = self.serialize_simple_string(data)
+        self._append_to_buffer(message)
 
-    async def write_simple_error(self, data: str):
+    def write_simple_error(self, data: str):
         """
         Writes a RESP simple error encoded message to the underlying stream.
         """
-        message = await self.serialize_simple_error(data)
-        await self.write(message)
+        message = self.serialize_simple_error(data)
+        self._append_to_buffer(message)
 
-    async def write_integer(self, data: int):
+    def write_integer(self, data: int):
         """
         Writes a RESP integer encoded message to the underlying stream.
         """
-        message = await self.serialize_integer(data)
-        await self.write(message)
+        message = self.serialize_integer(data)
+        self._append_to_buffer(message)
 
-    async def write_bulk_string(self, data: Optional[str]):
+    def write_bulk_string(self, data: Optional[bytes | str]):
         """
         Writes a RESP bulk string encoded message to the underlying stream.
         """
-        message = await self.serialize_bulk_string(data)
-        await self.write(message)
+        message = self.serialize_bulk_string(data)
+        self._append_to_buffer(message)
 
-    async def write(self, message: str):
+    def write_raw(self, message: bytes):
         """
-        Writes a serialized RESP message to the underlying stream.
+        Writes already encoded bytes to the write buffer, as is.
+        """
+        self._append_to_buffer(message)
 
-        This method encodes the provided `message` string (assumed to be
-        already in RESP format) into bytes and writes it to the `writer`
-        object. It then waits for the stream to be flushed to ensure all data
-        is sent.
+    def _append_to_buffer(self, data: bytes):
         """
-        self.writer.write(message.encode())
-        await self.writer.drain()
+        Copies `data` into the write buffer, right after the bytes already in
+        it. Within the buffer's size this overwrites bytes in place, past it
+        the slice assignment grows the buffer.
+        """
+        end = self.buffer_len + len(data)
+        self.buffer[self.buffer_len : end] = data
+        self.buffer_len = end
 
-    async def write_raw(self, message: bytes):
-        """ """
-        self.writer.write(message)
+    async def flush(self):
+        """
+        Sends everything in the write buffer to the underlying stream.
+
+        All messages buffered since the last flush go out in a single
+        `write`, instead of one syscall per message. The transport is handed a
+        copy, as it may hold on to the data it could not send yet, while the
+        buffer itself is kept for the next messages. It then waits for the
+        stream to be flushed to ensure all data is sent.
+        """
+        if not self.buffer_len:
+            return
+        self.writer.write(self.buffer[: self.buffer_len])
+        self.buffer_len = 0
+        if len(self.buffer) > MAX_BUFFER_SIZE:
+            self.buffer = bytearray(BUFFER_SIZE)
         await self.writer.drain()
 
     async def close(self):
         """
         Properly closes the underlying stream connection.
 
-        This method first sends an end-of-file signal (`write_eof`) to the
-        writer and then closes the connection. This ensures any remaining data
-        is sent and the connection is gracefully closed.
-        """
-        self.writer.write_eof()
+        This method first flushes any replies still in the write buffer, and
+        sends an end-of-file signal (`write_eof`) to the writer. It then
+        closes the connection, and waits for it to be closed. This ensures any
+        remaining data is sent and the connection is gracefully closed. If the
+        peer is already gone, there is nothing left to send.
+        """
+        try:
+            await self.flush()
+            self.writer.write_eof()
+        except ConnectionError:
+            pass
         self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+# Serializer of each type of RESP array element, looked up with the exact type
+# of the element, so it takes a single dict lookup instead of a chain of type
+# checks.
+ELEMENT_SERIALIZERS: dict[type, Callable[[RESPWriter, Any], bytes]] = {
+    bytes: RESPWriter.serialize_bulk_string,
+    str: RESPWriter.serialize_bulk_string,
+    type(None): RESPWriter.serialize_bulk_string,
+    int: RESPWriter.serialize_integer,
+    list: RESPWriter.serialize_array,
+}
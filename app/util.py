@@ -1,24 +1,30 @@
-import os
 import random
 import string
 
-from app.rdb import RDBParser
+from app.rdb import EmptyRDBError, RDBParser
+
+# Alphabet of the strings made by generate_random_string.
+RANDOM_STRING_CHARS = string.ascii_lowercase + string.digits
 
 
 def init_rdb_parser(
     parsing_reqd_flag: bool, rdb_file_path: str
-) -> dict[str, tuple[str, int]]:
+) -> tuple[dict[bytes, bytes], dict[bytes, int]]:
     """
     Simple utility function that only parses the .rdb file if parsing_reqd_flag
-    is set, and if the file exists. Returns the parsed key-value store, or an
-    empty dict.
+    is set, and if the file exists and isn't empty. Returns the parsed
+    key-value store and the expiry timestamps of its keys that have one, or
+    two empty dicts.
     """
-    if parsing_reqd_flag and os.path.isfile(rdb_file_path):
+    if not parsing_reqd_flag:
+        return {}, {}
+    # Opening the file tells if it exists, no need to stat it first.
+    try:
         parser = RDBParser(rdb_file_path)
-        return parser.kv
-    return {}
+    except (FileNotFoundError, IsADirectoryError, EmptyRDBError):
+        return {}, {}
+    return parser.kv, parser.expiries
 
 
 def generate_random_string(length: int) -> str:
-    chars = string.ascii_lowercase + string.digits
-    return "".join(random.choice(chars) for _ in range(length))
+    return "".join(random.choices(RANDOM_STRING_CHARS, k=length))